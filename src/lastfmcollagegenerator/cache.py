@@ -0,0 +1,50 @@
+import hashlib
+import logging
+import os
+import tempfile
+from typing import Optional
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+class TileImageCache:
+    """
+    Stores the already resized tile images on disk, keyed by the
+    SHA1 of the URL they were downloaded from
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = os.path.expanduser(cache_dir)
+
+    def get(self, url: str) -> Optional[Image.Image]:
+        try:
+            with Image.open(self._get_path(url)) as img:
+                img.load()
+                return img
+        except FileNotFoundError:
+            return None
+        except OSError:
+            logger.warning("Could not read cached tile image %s", url, exc_info=True)
+            return None
+
+    def set(self, url: str, image: Image.Image):
+        path = self._get_path(url)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    image.save(f, format="png")
+                # Other threads or processes never see a partial file
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        except OSError:
+            logger.warning("Could not cache tile image %s", url, exc_info=True)
+
+    def _get_path(self, url: str) -> str:
+        key = hashlib.sha1(url.encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
@@ -1,17 +1,21 @@
 import concurrent.futures
+import functools
+import html
 import logging
 import os
+import re
+import textwrap
 import urllib.parse
 from dataclasses import dataclass
 from io import BytesIO
-from typing import List, Tuple, Union
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
-import bs4
 import requests
+from requests.adapters import HTTPAdapter, Retry
 from pylast import User, TopItem, Album, Artist, Track
 from PIL import Image, ImageDraw, ImageFont, ImageFile
 
-import lastfmcollagegenerator
+from lastfmcollagegenerator.cache import TileImageCache
 from lastfmcollagegenerator.constants import ENTITY_ARTIST, ENTITY_ALBUM, \
     ENTITY_TRACK
 from lastfmcollagegenerator.exceptions import ArtistNotFound, ArtistImageNotFound
@@ -19,6 +23,30 @@ from lastfmcollagegenerator.lastfm.client import LastfmClient
 
 logger = logging.getLogger(__name__)
 
+_PKG_DIR = os.path.dirname(__file__)
+
+_ARTIST_IMAGE_URL_RE = re.compile(
+    rb'class="(?:[^"]*\s)?header-new-background-image(?:\s[^"]*)?"'
+    rb'[^>]*?\scontent="([^"]+)"'
+)
+_ARTIST_IMAGE_CLASS_RE = re.compile(r"(^|\s)header-new-background-image(\s|$)")
+
+_CHAR_WIDTH_CACHE: Dict[Tuple[str, int, str], float] = {}
+
+
+def _get_char_width(font: ImageFont, char: str) -> float:
+    """
+    Keyed on the font file and size rather than the font object, which
+    can be evicted from the font cache and its id reused by another font
+    """
+    key = (font.path, font.size, char)
+    width = _CHAR_WIDTH_CACHE.get(key)
+    if width is None:
+        width = font.getlength(char)
+        _CHAR_WIDTH_CACHE[key] = width
+    return width
+
+
 @dataclass
 class LastfmConfig:
     lastfm_api_key: str
@@ -35,10 +63,14 @@ class CollageBuilderConfig:
 
 @dataclass
 class CollageTile:
-    data: bytes
+    image: Optional[Image.Image]
     playcount: int
     title: str
 
+    @property
+    def is_blank(self) -> bool:
+        return self.image is None
+
 
 @dataclass
 class CollageConfig:
@@ -48,24 +80,31 @@ class CollageConfig:
 
 class BaseCollageBuilder:
     ENTITY = None
-    FONT_REGULAR_PATH = "fonts/DejaVuSansMono.ttf"
-    FONT_BOLD_PATH = "fonts/DejaVuSansMono-Bold.ttf"
+    FONT_REGULAR_PATH = os.path.join(_PKG_DIR, "fonts", "DejaVuSansMono.ttf")
+    FONT_BOLD_PATH = os.path.join(_PKG_DIR, "fonts", "DejaVuSansMono-Bold.ttf")
     FONT_SIZE = 15
     FONT_BOLD = False
     TILE_WIDTH = 300
     TILE_HEIGHT = 300
+    TITLE_MAX_WIDTH = 275
+    TITLE_MAX_LINES = 3
+    MAX_WORKERS = 10
+    HTTP_POOL_MAXSIZE = 25
+    HTTP_TIMEOUT = (3, 10)
+    HTTP_CHUNK_SIZE = 8192
+    HTTP_MAX_RETRIES = 2
+    HTTP_USER_AGENT = "lastfmcollagegenerator"
 
     def __init__(
             self,
             config: CollageBuilderConfig,
             lastfm_client: LastfmClient,
+            cache_dir: Optional[str] = None,
     ):
         ImageFile.LOAD_TRUNCATED_IMAGES = True
         self.config = config
         self.lastfm_client = lastfm_client
-        self._path = os.path.dirname(
-            lastfmcollagegenerator.collage.__file__
-        )
+        self.tile_cache = TileImageCache(cache_dir) if cache_dir else None
 
     def create(self, username: str) -> Image:
         user = self.lastfm_client.get_user(username)
@@ -78,12 +117,14 @@ class BaseCollageBuilder:
 
     def _create_image(
             self,
-            tiles: List[CollageTile],
+            tiles: Iterator[Tuple[int, CollageTile]],
             cols: int,
             rows: int
     ) -> Image:
         """
-        300px is the height and the width of the covers
+        300px is the height and the width of the covers.
+        Tiles are pasted as soon as they are downloaded, the index
+        is the rank of the item and sets its position in the grid
         """
         width = self.TILE_WIDTH
         height = self.TILE_HEIGHT
@@ -92,112 +133,239 @@ class BaseCollageBuilder:
 
         # create blank image of the full size
         new_image = Image.new("RGB", (collage_width, collage_height))
-        cursor = (0, 0)
-        for tile in tiles:
-            new_image.paste(Image.open(BytesIO(tile.data)), cursor)
+        # title boxes are drawn on a transparent overlay and blended at once
+        overlay = Image.new("RGBA", new_image.size, (0, 0, 0, 0))
+        overlay_draw = ImageDraw.Draw(overlay)
+        titles = []
+        for index, tile in tiles:
+            row, col = divmod(index, cols)
+            cursor = (col * width, row * height)
+            # blank tiles are already black in the new image
+            if not tile.is_blank:
+                new_image.paste(tile.image, cursor)
             title = f"{tile.title}"
             if self.config.show_playcount:
                 title += f". ({tile.playcount})"
+            self._insert_tile_title_box(draw=overlay_draw, cursor=cursor)
+            titles.append((title, cursor))
+        new_image.paste(overlay, (0, 0), overlay)
+
+        # the opaque text goes on the blended image, so its anti-aliased
+        # edges blend with the boxes and not with the transparent overlay
+        draw = ImageDraw.Draw(new_image)
+        font = self._get_font()
+        for title, cursor in titles:
             self._insert_tile_title(
-                image=new_image,
+                draw=draw,
+                font=font,
                 title=title,
                 cursor=cursor
             )
-
-            # move cursor to next tile
-            y = cursor[1]
-            x = cursor[0] + width
-            if cursor[0] >= (collage_width - width):
-                y = cursor[1] + height
-                x = 0
-            cursor = (x, y)
         return new_image
 
-    def _insert_tile_title(
+    def _insert_tile_title_box(
             self,
-            image: Image,
-            title: str,
+            draw: ImageDraw,
             cursor: Tuple[int, int]
     ):
-        draw = ImageDraw.Draw(image, "RGBA")
         x = cursor[0]
         y = cursor[1]
         y_0 = y + 235
-        y_1 = y * 2 + self.TILE_WIDTH
-        if y_1 == 0:
-            y_1 += self.TILE_WIDTH * 2
-        draw.rectangle(((x, y_0), (x + self.TILE_WIDTH, y_1)), (0, 0, 0, 123))
-
-        font_path = self.FONT_BOLD_PATH if self.FONT_BOLD else self.FONT_REGULAR_PATH
-        font = ImageFont.truetype(
-            f"{self._path}"
-            f"/{font_path}",
-            self.FONT_SIZE
-        )
+        y_1 = y + self.TILE_HEIGHT - 1
+        x_1 = x + self.TILE_WIDTH - 1
+        draw.rectangle(((x, y_0), (x_1, y_1)), (0, 0, 0, 123))
 
+    def _insert_tile_title(
+            self,
+            draw: ImageDraw,
+            font: ImageFont,
+            title: str,
+            cursor: Tuple[int, int]
+    ):
+        x = cursor[0]
+        y = cursor[1]
         title = self._insert_newline_characters_to_text(font, title)
+        # Tiles can be pasted in any order, so the title must not
+        # overflow into the tile below
+        title = "\n".join(title.split("\n")[:self.TITLE_MAX_LINES])
         draw.text((x + 8, y + 240), title, fill=(255, 255, 255), font=font)
 
+    def _get_font(self) -> ImageFont:
+        font_path = self.FONT_BOLD_PATH if self.FONT_BOLD else self.FONT_REGULAR_PATH
+        return self._load_font(font_path, self.FONT_SIZE)
+
     @staticmethod
-    def _insert_newline_characters_to_text(font: ImageFont, text: str) -> str:
-        processed_chars = []
-        processed_text = ""
+    @functools.lru_cache(maxsize=4)
+    def _load_font(font_path: str, font_size: int) -> ImageFont:
+        return ImageFont.truetype(font_path, font_size)
+
+    @classmethod
+    def _insert_newline_characters_to_text(
+            cls,
+            font: ImageFont,
+            text: str
+    ) -> str:
+        """
+        Wraps the text at word boundaries using the number of characters
+        that fit in a line, measuring each resulting line once
+        """
+        max_width = cls.TITLE_MAX_WIDTH
+        # most titles fit in a single line
+        if font.getlength(text) <= max_width:
+            return text
+        estimate = max(1, int(max_width // _get_char_width(font, "a")))
         text_lines = []
-        for c in text:
-            processed_chars.append(c)
-            processed_text = "".join(processed_chars)
-            font_w = font.getlength(processed_text)
-            if font_w >= 275:
-                text_lines.append(processed_text)
-                processed_chars = []
-                processed_text = ""
-        text_lines.append(processed_text)  # Add residual characters
+        for line in textwrap.wrap(text, width=estimate):
+            if font.getlength(line) <= max_width:
+                text_lines.append(line)
+            else:
+                # wider characters than the estimate, e.g. non latin
+                text_lines.extend(
+                    cls._split_line_by_width(font, line, estimate)
+                )
         title = "\n".join(text_lines)
         return title
 
     @classmethod
-    def _generate_blank_tile(cls) -> bytes:
-        img_bytes = BytesIO()
-        img = Image.new("RGB", (cls.TILE_WIDTH, cls.TILE_HEIGHT))
-        img.save(img_bytes, format="png")
-        img = img_bytes.getvalue()
+    def _split_line_by_width(
+            cls,
+            font: ImageFont,
+            text: str,
+            estimate: int
+    ) -> List[str]:
+        """
+        Starts from the estimated number of characters per line and
+        adjusts the line end one character at a time
+        """
+        max_width = cls.TITLE_MAX_WIDTH
+        text_lines = []
+        i = 0
+        while i < len(text):
+            j = min(len(text), i + estimate)
+            width = font.getlength(text[i:j])
+            while j < len(text):
+                char_width = _get_char_width(font, text[j])
+                if width + char_width > max_width:
+                    break
+                width += char_width
+                j += 1
+            while width > max_width and j - i > 1:
+                j -= 1
+                width -= _get_char_width(font, text[j])
+            text_lines.append(text[i:j])
+            i = j
+        return text_lines
+
+    def _download_tile_image(self, url: str) -> Image.Image:
+        if self.tile_cache:
+            img = self.tile_cache.get(url)
+            if img is not None:
+                return img
+        response = self._http_session().get(
+            url,
+            timeout=self.HTTP_TIMEOUT
+        ).content
+        img = self._open_tile_image(response)
+        if self.tile_cache:
+            self.tile_cache.set(url, img)
+        return img
+
+    @classmethod
+    def _open_tile_image(cls, data: bytes) -> Image.Image:
+        """
+        Decodes a downloaded image once and fits it into a tile
+        """
+        with Image.open(BytesIO(data)) as source:
+            # JPEGs can be scaled down by libjpeg while decoding, no-op
+            # otherwise. The drafted image is never smaller than the tile
+            source.draft("RGB", (cls.TILE_WIDTH, cls.TILE_HEIGHT))
+            source.load()
+            img = source.convert("RGB")
+        img.thumbnail(
+            (cls.TILE_WIDTH, cls.TILE_HEIGHT),
+            Image.Resampling.LANCZOS
+        )
         return img
 
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _http_session() -> requests.Session:
+        """
+        Shared session so the covers fetched by the tile threads
+        reuse the keep-alive connections to the Last.fm hosts
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_maxsize=BaseCollageBuilder.HTTP_POOL_MAXSIZE,
+            pool_block=False,
+            max_retries=Retry(
+                total=BaseCollageBuilder.HTTP_MAX_RETRIES,
+                backoff_factor=0.2
+            )
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers["User-Agent"] = BaseCollageBuilder.HTTP_USER_AGENT
+        return session
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _executor() -> concurrent.futures.ThreadPoolExecutor:
+        """
+        Shared pool for the tile downloads, kept alive between collages
+        """
+        return concurrent.futures.ThreadPoolExecutor(
+            max_workers=BaseCollageBuilder.MAX_WORKERS,
+            thread_name_prefix="collage"
+        )
+
     def _get_tiles_from_top_items(
             self,
             user: User,
             limit: int,
             period: str
-    ) -> List[CollageTile]:
+    ) -> Iterator[Tuple[int, CollageTile]]:
         raise NotImplementedError
 
-    @classmethod
     def _create_tiles_from_top_items(
-            cls,
+            self,
             top_items: List[TopItem],
-    ) -> List[CollageTile]:
-        tiles: List[CollageTile] = []
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = []
-            for top_item in top_items:
-                future = executor.submit(
-                    cls._create_tile_from_top_item,
-                    top_item,
-                )
-                futures.append(future)
-            for future in concurrent.futures.as_completed(futures):
-                tiles.append(future.result())
-        tiles.sort(key=lambda x: int(x.playcount), reverse=True)
-        return tiles
+    ) -> Iterator[Tuple[int, CollageTile]]:
+        """
+        Yields (index, tile) pairs in completion order. The index is the
+        position of the item in the Last.fm top, already ranked by playcount
+        """
+        # lru_cache does not stop concurrent first calls from each building
+        # a session, so create it here before the tile threads ask for it
+        self._http_session()
+        executor = self._executor()
+        futures = {
+            executor.submit(self._create_tile_from_top_item, top_item): i
+            for i, top_item in enumerate(top_items)
+        }
+        return (
+            (futures[future], future.result())
+            for future in concurrent.futures.as_completed(futures)
+        )
 
-    @classmethod
     def _create_tile_from_top_item(
-            cls,
+            self,
             top_item: TopItem,
     ) -> CollageTile:
         raise NotImplementedError
 
 
+if hasattr(os, "register_at_fork"):
+    # The pool threads and the pooled connections do not survive a fork,
+    # a forked child builds its own on first use
+    os.register_at_fork(
+        after_in_child=BaseCollageBuilder._executor.cache_clear
+    )
+    os.register_at_fork(
+        after_in_child=BaseCollageBuilder._http_session.cache_clear
+    )
+
+
 class ArtistCollageBuilder(BaseCollageBuilder):
     ENTITY = ENTITY_ARTIST
 
@@ -206,58 +374,89 @@ class ArtistCollageBuilder(BaseCollageBuilder):
             user: User,
             limit: int,
             period: str
-    ) -> List[CollageTile]:
+    ) -> Iterator[Tuple[int, CollageTile]]:
         top_artists = self.lastfm_client.get_top_artists(user, limit, period)
         return self._create_tiles_from_top_items(top_artists)
 
-    @classmethod
     def _create_tile_from_top_item(
-            cls,
+            self,
             top_item: TopItem,
     ) -> CollageTile:
-        data = cls._get_artist_image(top_item.item)
+        image = self._get_artist_image(top_item.item)
         title = top_item.item.name
         return CollageTile(
-            data=data,
+            image=image,
             playcount=top_item.weight,
             title=title
         )
 
-    @classmethod
-    def _get_artist_image(cls, artist: Artist) -> bytes:
+    def _get_artist_image(self, artist: Artist) -> Optional[Image.Image]:
         """
         Last.fm API does not provide artist images.
         So we scrape it from the website.
+        Returns None when there is no image for the artist
         """
         try:
-            resp = requests.get("https://www.last.fm/music/{artist}".format(
-                artist=urllib.parse.quote_plus(artist.name)
-            ))
+            url = self._get_artist_image_url(artist.name)
+            return self._download_tile_image(url)
+        except (ArtistNotFound, ArtistImageNotFound):
+            return None
+
+    @classmethod
+    @functools.lru_cache(maxsize=1024)
+    def _get_artist_image_url(cls, artist_name: str) -> str:
+        """
+        Scraped URLs are kept for the whole process, so the artist page
+        is only requested once per artist. Missing artists or images
+        raise and are therefore not cached
+        """
+        url = cls._scrape_artist_image_url(artist_name)
+        if not url:
+            raise ArtistImageNotFound
+        return url
+
+    @classmethod
+    def _scrape_artist_image_url(cls, artist_name: str) -> Optional[str]:
+        """
+        The artist page is streamed and the download stops as soon as
+        the header with the image is found, which is near the top
+        """
+        content = bytearray()
+        with cls._http_session().get(
+                "https://www.last.fm/music/{artist}".format(
+                    artist=urllib.parse.quote_plus(artist_name)
+                ),
+                timeout=cls.HTTP_TIMEOUT,
+                stream=True
+        ) as resp:
             if resp.status_code == 404:
                 raise ArtistNotFound
-            soup = bs4.BeautifulSoup(resp.content, 'html5lib')
+            for chunk in resp.iter_content(cls.HTTP_CHUNK_SIZE):
+                # the tag may start in the previous chunk
+                start = max(0, len(content) - cls.HTTP_CHUNK_SIZE)
+                content += chunk
+                match = _ARTIST_IMAGE_URL_RE.search(content, start)
+                if match:
+                    return html.unescape(match.group(1).decode("utf-8"))
+        return cls._parse_artist_image_url(bytes(content))
 
-            url = None
-            if soup.find(class_="header-new-background-image"):
-                url = str(
-                    soup.find(
-                        class_="header-new-background-image"
-                    ).get("content")
-                )
-            if not url:
-                raise ArtistImageNotFound
-
-            response = requests.get(url).content
-            img = Image.open(BytesIO(response))
-            img.seek(0)
-            img.thumbnail((cls.TILE_WIDTH, cls.TILE_HEIGHT))
-            img_bytes = BytesIO()
-            img.save(img_bytes, format="png")
-            img = img_bytes.getvalue()
-            return img
-        except (ArtistNotFound, ArtistImageNotFound):
-            return cls._generate_blank_tile()
+    @staticmethod
+    def _parse_artist_image_url(content: bytes) -> Optional[str]:
+        """
+        Fallback for pages the regex does not match, bs4 is only
+        imported when it is needed
+        """
+        import bs4
 
+        # Only the artist header is needed from the whole artist page
+        soup = bs4.BeautifulSoup(
+            content,
+            "html.parser",
+            parse_only=bs4.SoupStrainer(class_=_ARTIST_IMAGE_CLASS_RE)
+        )
+        tag = soup.find(class_="header-new-background-image")
+        url = tag.get("content") if tag is not None else None
+        return str(url) if url else None
 
     def __repr__(self):
         return f"<ArtistCollage [" \
@@ -274,38 +473,35 @@ class AlbumCollageBuilder(BaseCollageBuilder):
             user: User,
             limit: int,
             period: str
-    ) -> List[CollageTile]:
+    ) -> Iterator[Tuple[int, CollageTile]]:
         top_albums = self.lastfm_client.get_top_albums(user, limit, period)
         return self._create_tiles_from_top_items(top_albums)
 
-    @classmethod
     def _create_tile_from_top_item(
-            cls,
+            self,
             top_item: TopItem,
 
     ) -> CollageTile:
-        data = cls._get_album_cover(top_item.item)
+        image = self._get_album_cover(top_item.item)
         title = f"{top_item.item.artist} - {top_item.item.title}"
         return CollageTile(
-            data=data,
+            image=image,
             playcount=top_item.weight,
             title=title
         )
 
-    @classmethod
     def _get_album_cover(
-            cls,
+            self,
             item: Union[Album, Track]
-    ) -> bytes:
+    ) -> Optional[Image.Image]:
         try:
             url = item.get_cover_image()
         except IndexError:
             url = None
         if not url:
-            img = cls._generate_blank_tile()
+            img = None
         else:
-            img = requests.get(url).content
-            Image.open(BytesIO(img)).seek(0)
+            img = self._download_tile_image(url)
         return img
 
     def __repr__(self):
@@ -323,7 +519,7 @@ class TrackCollageBuilder(AlbumCollageBuilder):
             user: User,
             limit: int,
             period: str
-    ) -> List[CollageTile]:
+    ) -> Iterator[Tuple[int, CollageTile]]:
         top_tracks = self.lastfm_client.get_top_tracks(user, limit, period)
         return self._create_tiles_from_top_items(top_tracks)
 
@@ -345,9 +541,10 @@ class CollageBuilderFactory:
             cls,
             entity: str,
             config: CollageBuilderConfig,
-            lastfm_client: LastfmClient
+            lastfm_client: LastfmClient,
+            cache_dir: Optional[str] = None
     ):
         collage_builder = cls.entity_collage_builders.get(entity)
         if not collage_builder:
             raise ValueError(f"Invalid entity: {entity}")
-        return collage_builder(config, lastfm_client)
+        return collage_builder(config, lastfm_client, cache_dir)
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from PIL import Image
 
 from lastfmcollagegenerator.collage import CollageBuilderFactory, LastfmConfig, \
@@ -14,11 +16,21 @@ class CollageGenerator:
     MAX_COLS = 5
     MAX_ROWS = 5
 
-    def __init__(self, lastfm_api_key: str, lastfm_api_secret: str):
+    def __init__(
+            self,
+            lastfm_api_key: str,
+            lastfm_api_secret: str,
+            cache_dir: Optional[str] = None
+    ):
+        """
+        cache_dir: optional directory where the resized covers are kept
+        between collages
+        """
         self.lastfm_config = LastfmConfig(
             lastfm_api_key=lastfm_api_key,
             lastfm_api_secret=lastfm_api_secret
         )
+        self.cache_dir = cache_dir
 
     def generate(
             self,
@@ -51,7 +63,8 @@ class CollageGenerator:
         return CollageBuilderFactory(
             entity=entity,
             config=collage_builder_config,
-            lastfm_client=lastfm_client
+            lastfm_client=lastfm_client,
+            cache_dir=self.cache_dir
         )
 
     def _validate_parameters(
@@ -18,7 +18,9 @@ class LastfmClient:
     @staticmethod
     def get_top_albums(user: User, limit: int, period: str) -> List[TopItem]:
         """
-        Returns a list of TopItems with the albums and the play count
+        Returns a list of TopItems with the albums and the play count.
+        The albums already carry the cover URLs of the response, so
+        get_cover_image() does not make an album.getInfo request per album
         TODO: It will be necessary to do a custom request because pylast doesn't support page param in this query
         """
         top_albums = user.get_top_albums(period=period, limit=limit)
@@ -36,7 +38,9 @@ class LastfmClient:
     @staticmethod
     def get_top_tracks(user: User, limit: int, period: str) -> List[TopItem]:
         """
-        Returns a list of TopItems with the tracks and the play count
+        Returns a list of TopItems with the tracks and the play count.
+        user.getTopTracks only returns placeholder images, so the cover
+        of each track still comes from track.getInfo
         TODO: It will be necessary to do a custom request because pylast doesn't support page param in this query
         """
         top_tracks = user.get_top_tracks(period=period, limit=limit)
@@ -0,0 +1,150 @@
+import os
+import tempfile
+import unittest
+from io import BytesIO
+from unittest import mock
+
+from PIL import Image
+
+from lastfmcollagegenerator.cache import TileImageCache
+from lastfmcollagegenerator.collage import (
+    AlbumCollageBuilder,
+    ArtistCollageBuilder,
+    BaseCollageBuilder,
+)
+
+
+class FakeResponse:
+    def __init__(self, content: bytes, status_code: int = 200):
+        self.content = content
+        self.status_code = status_code
+
+    def iter_content(self, chunk_size: int):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class ScrapeArtistImageUrlTestCase(unittest.TestCase):
+    def _scrape(self, page: bytes):
+        session = mock.Mock()
+        session.get.return_value = FakeResponse(page)
+        with mock.patch.object(
+                ArtistCollageBuilder,
+                "_http_session",
+                return_value=session
+        ):
+            return ArtistCollageBuilder._scrape_artist_image_url("artist")
+
+    def test_class_before_content(self):
+        page = b'<div class="header-new-background-image" ' \
+               b'content="https://example.com/a.jpg"></div>'
+        self.assertEqual(self._scrape(page), "https://example.com/a.jpg")
+
+    def test_content_before_class_uses_fallback(self):
+        page = b"<html>" + b"x" * 20000 + \
+               b'<div content="https://example.com/b.jpg" ' \
+               b'class="header-new-background-image"></div></html>'
+        self.assertEqual(self._scrape(page), "https://example.com/b.jpg")
+
+    def test_no_image(self):
+        self.assertIsNone(self._scrape(b"<html><body></body></html>"))
+
+
+class TileImageCacheTestCase(unittest.TestCase):
+    URL = "https://example.com/cover.jpg"
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.cache_dir = tmp_dir.name
+        self.cache = TileImageCache(self.cache_dir)
+
+    def test_set_get(self):
+        self.cache.set(self.URL, Image.new("RGB", (300, 300), (255, 0, 0)))
+        img = self.cache.get(self.URL)
+        self.assertEqual(img.size, (300, 300))
+        self.assertEqual(img.getpixel((0, 0)), (255, 0, 0))
+
+    def test_miss(self):
+        self.assertIsNone(self.cache.get(self.URL))
+
+    def test_corrupt_entry(self):
+        path = self.cache._get_path(self.URL)
+        os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(b"not an image")
+        with self.assertLogs("lastfmcollagegenerator.cache", "WARNING"):
+            self.assertIsNone(self.cache.get(self.URL))
+
+    def test_unwritable_cache_dir(self):
+        # a file where the cache directory should be
+        cache_file = os.path.join(self.cache_dir, "file")
+        open(cache_file, "wb").close()
+        cache = TileImageCache(cache_file)
+        with self.assertLogs("lastfmcollagegenerator.cache", "WARNING"):
+            cache.set(self.URL, Image.new("RGB", (300, 300)))
+        self.assertIsNone(cache.get(self.URL))
+
+
+class DownloadTileImageTestCase(unittest.TestCase):
+    URL = "https://example.com/cover.jpg"
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.builder = AlbumCollageBuilder(
+            config=mock.Mock(),
+            lastfm_client=mock.Mock(),
+            cache_dir=tmp_dir.name
+        )
+        self.session = mock.Mock()
+        patcher = mock.patch.object(
+            AlbumCollageBuilder,
+            "_http_session",
+            return_value=self.session
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cache_miss_downloads_and_stores(self):
+        data = BytesIO()
+        Image.new("RGB", (600, 600), (0, 0, 255)).save(data, format="jpeg")
+        self.session.get.return_value.content = data.getvalue()
+        img = self.builder._download_tile_image(self.URL)
+        self.assertEqual(img.size, (300, 300))
+        self.session.get.assert_called_once()
+        self.assertIsNotNone(self.builder.tile_cache.get(self.URL))
+
+    def test_cache_hit_skips_download(self):
+        self.builder.tile_cache.set(
+            self.URL,
+            Image.new("RGB", (300, 300), (0, 255, 0))
+        )
+        img = self.builder._download_tile_image(self.URL)
+        self.assertEqual(img.getpixel((0, 0)), (0, 255, 0))
+        self.session.get.assert_not_called()
+
+
+@unittest.skipUnless(hasattr(os, "fork"), "requires os.fork")
+class ForkTestCase(unittest.TestCase):
+    def test_executor_works_in_forked_child(self):
+        BaseCollageBuilder._executor().submit(int).result()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                future = BaseCollageBuilder._executor().submit(int, "1")
+                os._exit(0 if future.result(timeout=3) == 1 else 1)
+            except BaseException:
+                os._exit(2)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()